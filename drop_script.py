@@ -4,38 +4,190 @@
 # usage:  copy script into shell of running XR machine
 # to execute, just do "nohup python3 ./drop_script.py -n 60 -t 60 &> npudrops.log &"
 # this will run it 60 times, once every 60 seconds, (i.e. for 1 hour) 
+# output: a <host>_meta_* tar of the run-once commands, then a <host>_delta_* tar per run.
+# to read one back (needs the .zdict-* and earlier delta files in the same dir):
+#   python3 -c "import drop_script; print(drop_script.loadSnapshot('<dir>/<delta file>'))"
 
 
 import argparse
+import concurrent.futures
+import contextlib
 import datetime
+import functools
+import hashlib
+import io
+import itertools
 import json
 import logging
 import lzma
 import os
+import shlex
+import shutil
+import signal
 import subprocess
+import tarfile
 import time
 
+try:
+    import zstandard as zstd    # much cheaper than LZMA per snapshot, but not on every XR image
+except ImportError:
+    zstd = None
+
+try:
+    import orjson               # C serializer for structured entries, falls back to the stdlib json module
+except ImportError:
+    orjson = None
+
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s", datefmt="%H:%M:%S")
 log = logging.getLogger(__name__)
 
-def getOutputfile(args, commandOutput):
-    """ build the path/filename for the output file"""
-    snapshot_dir = args.output_dir
-    if not os.path.exists(snapshot_dir):
-        os.mkdir(snapshot_dir)
-    log.info(f"Using output directory {snapshot_dir}")
-    snapTime = datetime.datetime.fromtimestamp(int(commandOutput["timestamp"]))
+SNAPSHOT_EXT = ".tar.zst" if zstd else ".tar.xz"
+MAX_CONCURRENT_CMDS = 8     # commands allowed to run at the same time
+CMD_TIMEOUT = 180           # seconds allowed per command (a batched shell gets this per command in it)
+DEDUP_MIN_SIZE = 512        # entries smaller than a tar header aren't worth replacing with a reference
+DEDUP_INDEX = "_dedup.json" # tar member listing the entries that were unchanged since the last snapshot
+DEDUP_RESET_RUNS = 60       # every Nth delta snapshot is written in full, with no references to older files
+ZDICT_TRAINING_RUNS = 3     # snapshots to sample before training a zstd dictionary
+ZDICT_SIZE = 128 * 1024
+BATCH_SEP = b"\0SEP\0"      # marks the start of each command's output inside a batched shell
+BATCH_PRINTF = BATCH_SEP.decode().replace("\0", "\\0") + "%s\\0"    # same marker as printf escapes, + NUL-terminated handle
+
+def getOutputfile(snapshot_dir, filename_leader, kind, timestamp, run=None):
+    """ build the path/filename for an output file - kind is "meta" or "delta" """
+    snapTime = datetime.datetime.fromtimestamp(int(timestamp))
     timestamp = snapTime.strftime("%y%m%d-%H%M%S")
-    filename_leader = args.leader + commandOutput["etcHostname"].strip() 
-    out_fname = filename_leader + "_cmds_" + timestamp + ".json.xz"     # assemble output filename
-    output_fullpath = "/".join([snapshot_dir, out_fname])
-    return output_fullpath
+    if run is not None:
+        timestamp += f"_{run:05d}"      # runs less than a second apart mustn't overwrite each other
+    out_fname = filename_leader + f"_{kind}_" + timestamp + SNAPSHOT_EXT     # assemble output filename
+    return os.path.join(snapshot_dir, out_fname)
+
+def encodeEntry(output):
+    """(tar member suffix, contents) for one snapshot entry"""
+    if isinstance(output, bytes):
+        return ".txt", output
+    if isinstance(output, str):
+        return ".txt", output.encode("utf-8")
+    if orjson:
+        try:
+            return ".json", orjson.dumps(output)
+        except TypeError:       # e.g. ints over 64 bits, which the stdlib json module handles
+            pass
+    return ".json", json.dumps(output, separators=(',', ':'), ensure_ascii=False).encode("utf-8")
+
+class SnapshotWriter:
+    """context manager that streams entries into a compressed tar, one <handle>.txt member each.
+    unchanged entries (per the dedup dict) are only listed in DEDUP_INDEX"""
+    def __init__(self, filename: str, cctx=None, samples=None, dedup=None):
+        self.filename = filename
+        self.samples = samples
+        self.dedup = dedup
+        self._refs = {}
+        self._cctx = cctx
+        self._rawfile = None
+        self._outfile = None
+        self._tarfile = None
+
+    def __enter__(self):
+        log.info("streaming compressed tar output to %s.", self.filename)
+        if zstd:
+            cctx = self._cctx or zstd.ZstdCompressor(level=3)
+            self._rawfile = open(self.filename, "wb")
+            self._outfile = cctx.stream_writer(self._rawfile)
+        else:
+            self._outfile = lzma.open(self.filename, "wb", format=lzma.FORMAT_XZ, preset=1)
+        self._tarfile = tarfile.open(fileobj=self._outfile, mode="w|")
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._refs:
+            self._addMember(DEDUP_INDEX, encodeEntry(self._refs)[1])
+        self._tarfile.close()
+        self._outfile.close()
+        if self._rawfile:
+            self._rawfile.close()
 
-def saveJsonXz(cmdOutput: dict, filename: str) -> None:
-    with lzma.open(filename, "wt", encoding='utf-8') as outfile:
-        log.info(f"json.dump-ing compressed JSON output to {filename}.")
-        json.dump(cmdOutput, outfile, indent=4)
+    def _addMember(self, name: str, contents: bytes) -> None:
+        info = tarfile.TarInfo(name)
+        info.size = len(contents)
+        info.mtime = int(time.time())
+        self._tarfile.addfile(info, io.BytesIO(contents))
+
+    def write_entry(self, handle: str, output) -> None:
+        suffix, contents = encodeEntry(output)
+        if self.dedup is not None and len(contents) >= DEDUP_MIN_SIZE:
+            digest = hashlib.blake2b(contents, digest_size=8).hexdigest()
+            last = self.dedup.get(handle)
+            if last and last[0] == digest and last[1] != os.path.basename(self.filename):
+                self._refs[handle + suffix] = {"ref": digest, "snapshot": last[1]}
+                return
+            self.dedup[handle] = (digest, os.path.basename(self.filename))
+        self._addMember(handle + suffix, contents)
+        if self.samples is not None:
+            self.samples.append(contents)
+
+    __setitem__ = write_entry
+
+    def update(self, entries: dict) -> None:
+        for handle, output in entries.items():
+            self.write_entry(handle, output)
+
+@contextlib.contextmanager
+def openSnapshot(filename: str):
+    """open a snapshot as a streaming tar, loading its .zdict-<id> if it was written with one"""
+    if not filename.endswith(".zst"):
+        with tarfile.open(filename, mode="r|xz") as tar:
+            yield tar
+        return
+    with open(filename, "rb") as rawfile:
+        dict_id = zstd.get_frame_parameters(rawfile.read(18)).dict_id
+        zdict = None
+        if dict_id:
+            with open(os.path.join(os.path.dirname(filename), f".zdict-{dict_id}"), "rb") as dictfile:
+                zdict = zstd.ZstdCompressionDict(dictfile.read())
+        rawfile.seek(0)
+        with tarfile.open(fileobj=zstd.ZstdDecompressor(dict_data=zdict).stream_reader(rawfile), mode="r|") as tar:
+            yield tar
+
+def loadSnapshot(filename: str, with_meta=True) -> dict:
+    """read a snapshot back into {handle: output}, resolving DEDUP_INDEX refs and (with_meta) its metaFile"""
+    snapshot_dir = os.path.dirname(filename)
+    members = {}
+    with openSnapshot(filename) as tar:
+        for info in tar:
+            members[info.name] = tar.extractfile(info).read()
+    refs = json.loads(members.pop(DEDUP_INDEX, b"{}"))
+    for source in {ref["snapshot"] for ref in refs.values()}:
+        source_path = os.path.join(snapshot_dir, source)
+        if not os.path.exists(source_path):
+            raise FileNotFoundError(f"{filename} refers to {source} for unchanged entries, but it's missing")
+        with openSnapshot(source_path) as tar:
+            for info in tar:
+                if info.name in refs and refs[info.name]["snapshot"] == source:
+                    members[info.name] = tar.extractfile(info).read()
+    for name, ref in refs.items():
+        if name not in members or hashlib.blake2b(members[name], digest_size=8).hexdigest() != ref["ref"]:
+            raise ValueError(f"{filename}: {name} isn't in {ref['snapshot']} as referenced")
+    snapshot = {}
+    for name, contents in members.items():
+        handle, _, suffix = name.rpartition(".")
+        snapshot[handle] = json.loads(contents) if suffix == "json" else contents
+    if with_meta and "metaFile" in snapshot:
+        snapshot = {**loadSnapshot(os.path.join(snapshot_dir, snapshot["metaFile"].decode()), with_meta=False), **snapshot}
+    return snapshot
+
+def trainSnapshotDict(snapshot_dir: str, samples: list):
+    """train a zstd dictionary on samples and save it as .zdict-<dict id>; None if training fails"""
+    try:
+        zdict = zstd.train_dictionary(ZDICT_SIZE, samples)
+    except zstd.ZstdError as err:
+        log.info("couldn't train a zstd dictionary (%s), continuing without one", err)
+        return None
+    dict_path = os.path.join(snapshot_dir, f".zdict-{zdict.dict_id()}")
+    with open(dict_path, "wb") as dictfile:
+        dictfile.write(zdict.as_bytes())
+    log.info("trained zstd dictionary on %d entries, saved to %s", len(samples), dict_path)
+    return zdict
 
 def getParser():
     parser = argparse.ArgumentParser()
@@ -45,26 +197,77 @@ def getParser():
     parser.add_argument("-l", "--leader", default = '', help="descriptive string prepended to snapshot filenames")
     return parser.parse_args()
 
-def runCommands(cmdTable) -> dict:
-    """return a dictionary of captured output from commands defined in cmdTable.
+def batchCommands(cmdTable, cmdGroups) -> dict:
+    """fold each group of commands into one 'sh -c' script, marking each output with BATCH_SEP"""
+    procTable = {}
+    batched = set()
+    for group, handles in cmdGroups.items():
+        script = "; ".join(f"printf '{BATCH_PRINTF}' {shlex.quote(h)}; {shlex.join(cmdTable[h])}" for h in handles)
+        procTable[group] = ["sh", "-c", script]
+        batched.update(handles)
+    procTable.update({handle: cmd for handle, cmd in cmdTable.items() if handle not in batched})
+    return procTable
+
+def splitBatchOutput(stdout: bytes) -> dict:
+    """inverse of batchCommands(): turn one batched shell's stdout back into {handle: output}"""
+    batchOutput = {}
+    for chunk in stdout.split(BATCH_SEP)[1:]:
+        handle, _, output = chunk.partition(b"\0")
+        batchOutput[handle.decode()] = output
+    return batchOutput
+
+@functools.lru_cache(maxsize=None)
+def findExecutable(name: str) -> str:
+    """absolute path for name, so subprocess can use posix_spawn (or just name if not on PATH)"""
+    return shutil.which(name) or name
+
+def runProcess(handle, argv, timeout=CMD_TIMEOUT, batched=False):
+    """run one command, returning its stdout - or None if it doesn't exist on this system"""
+    try:
+        proc = subprocess.Popen(argv, executable=findExecutable(argv[0]), bufsize=-1, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, close_fds=False, start_new_session=batched)
+    except FileNotFoundError:
+        log.debug("process handle %s could not execute --  likely because fixed vs. distributed", handle)
+        return None
+    try:
+        return proc.communicate(timeout=timeout)[0]  # keep the stdout portion
+    except subprocess.TimeoutExpired:
+        if batched:
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+        proc.stdout.close()     # don't wait on output from anything that escaped the kill
+        proc.stderr.close()
+        proc.wait()
+        raise TimeoutError(f"killed process with handle '{handle}' : timed out")
+
+def runCommands(cmdTable, cmdGroups=None, out=None):
+    """return a dictionary of captured output from commands defined in cmdTable (stored into out, if given).
     Note: not all of these commands will exist on all systems (e.g. the fabric stuff doesn't 
     exist on a fixed system. 
     """
-    procOutput = {}  # dict to store output text from show commands 
-    procHandles = {}
-    for cmd in cmdTable.keys():
-        try:
-            procHandles[cmd] = subprocess.Popen(cmdTable[cmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        except FileNotFoundError:
-            log.debug(f"process handle {cmd} could not execute --  likely because fixed vs. distributed")
-    for handle, proc in procHandles.items():
-        try:
-            procOutput[handle] = proc.communicate(timeout=180)[0]  # turn stdout portion into text
-        except subprocess.TimeoutExpired:
-            proc.kill()
-            raise TimeoutError(f"killed process with handle '{handle}' : timed out")
-    return procOutput
-
+    cmdGroups = cmdGroups or {}
+    out = {} if out is None else out  # where to store output text from show commands
+    procTable = batchCommands(cmdTable, cmdGroups)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CMDS) as executor:
+        futures = {executor.submit(runProcess, handle, argv, CMD_TIMEOUT * len(cmdGroups.get(handle, [handle])),
+                                   handle in cmdGroups): handle
+                   for handle, argv in procTable.items()}
+        for future in concurrent.futures.as_completed(futures):
+            handle = futures[future]
+            try:
+                stdout = future.result()
+            except TimeoutError:
+                # don't launch the commands still queued behind the one that timed out
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+            if stdout is None:
+                continue
+            if handle in cmdGroups:
+                out.update(splitBatchOutput(stdout))
+            else:
+                out[handle] = stdout
+    return out
 
 runOnceCmdTable = {
     "showVersion": ["show_version"],        # XR: "show version"
@@ -74,56 +277,95 @@ runOnceCmdTable = {
     "showNpuSlice": ["show_slicemgr", "-I", "0xff", "-n", "A"],   # XR: show contr npu slice info...
 }
 
-loopCmdTable = {                # will run these each time
+stampCmdTable = {               # run first each time - the snapshot filename is built from it
     "timestamp": ["date", "+%s"],           # XR: "show clock"
+}
+
+loopCmdTable = {                # will run these each time
     "showPolMapInt": ["qos_ma_show_stats", "-i", "Bundle-Ether21", "-p", "0x1", "-q", "0x2",]
 }
 
+loopCmdGroups = {}              # loopCmdTable handles to run together in one shell, per (LC, NPU)
+
 # build the command strings to show voq state for the bundle members we're interested in...  "TenGigE0_11_0_x_y"
 bundlemembers = []
 for m_port in ['2', '3', '4']:
     for m_breakout in ['0', '1', '2', '3']:
         bundlemembers.append(f"TenGigE0_11_0_{m_port}_{m_breakout}")
 
-# add the member voq commands to the table of commands to run
-for card in [0,11]:
-    for member in bundlemembers:
-        voq_ingress_stats = ["ofa_npu_stats_show", "-v", "a", "-i", "0x10", "-n", "0", "-t", "s", "-p", f"{member}",]
-        voq_ingress_stats += ["-s", "0x0", "-d", "0x0", "-T", "0x0", "-P", "0xffffffff", "-c", "0xff",]
-        loopCmdTable[f"voqs_member{member}"] = voq_ingress_stats
-
-    for npu_inst in range(3):
-            # create commands to clear the counters (we run this once at the beginning)
-        clrNpuCmd = ["npd_npu_driver_clear", "-c", "s", "-i", f"0x{str(npu_inst)}", "-n", f"{str(256*card)}"]
-        runOnceCmdTable[f"clear_command_{card}_{npu_inst}"] = clrNpuCmd
-            # build the show command for each (LC, NPU) tuple
-        npuStats = ["ofa_npu_stats_show", "-v", "a", "-t", "e", "-p", "0xffffffff", "-s", "0x0", "-d", "A",]
-        npuStats = npuStats + ["-i", f"0x{str(npu_inst)}", "-n", f"{str(256*card)}"]
-        read_dvoq = ["npu_driver_show", "-c", "script read_dvoq_qsm", "-u", f"0x{npu_inst}", "-n", f"{str(256*card)}",]
-        oq_debug = ["npu_driver_show", "-c", "script sf_oq_debug_full true", "-u", f"0x{npu_inst}", "-n", f"{str(256*card)}",]
-        summ_ctrs = ["npu_driver_show", "-c", "script print_get_counters true", "-u", f"0x{npu_inst}", "-n", f"{str(256*card)}",]
-            # add them to the list of commands to loop...
-        loopCmdTable[f"npu_drops{card}_{npu_inst}"] = npuStats
-        loopCmdTable[f"dvoq_check{card}_{npu_inst}"] = read_dvoq
-        loopCmdTable[f"oq_debug_full{card}_{npu_inst}"] = oq_debug
-        loopCmdTable[f"summ_ctrs{card}_{npu_inst}"] = summ_ctrs
+# add the member voq commands to the table of commands to run (these aren't per-card)
+for member in bundlemembers:
+    voq_ingress_stats = ("ofa_npu_stats_show", "-v", "a", "-i", "0x10", "-n", "0", "-t", "s", "-p", member,
+                         "-s", "0x0", "-d", "0x0", "-T", "0x0", "-P", "0xffffffff", "-c", "0xff",)
+    loopCmdTable[f"voqs_member{member}"] = voq_ingress_stats
+
+# (LC, NPU) -> the (npu instance, node id) argument strings, formatted once
+npuArgs = {(card, npu_inst): (f"0x{npu_inst}", str(256*card)) for card, npu_inst in itertools.product([0, 11], range(3))}
+
+for (card, npu_inst), (npu_id, node_id) in npuArgs.items():
+        # create commands to clear the counters (we run this once at the beginning)
+    runOnceCmdTable[f"clear_command_{card}_{npu_inst}"] = ("npd_npu_driver_clear", "-c", "s", "-i", npu_id, "-n", node_id)
+        # build the show commands for each (LC, NPU) tuple
+    npuStats = ("ofa_npu_stats_show", "-v", "a", "-t", "e", "-p", "0xffffffff", "-s", "0x0", "-d", "A", "-i", npu_id, "-n", node_id)
+    read_dvoq = ("npu_driver_show", "-c", "script read_dvoq_qsm", "-u", npu_id, "-n", node_id)
+    oq_debug = ("npu_driver_show", "-c", "script sf_oq_debug_full true", "-u", npu_id, "-n", node_id)
+    summ_ctrs = ("npu_driver_show", "-c", "script print_get_counters true", "-u", npu_id, "-n", node_id)
+        # add them to the list of commands to loop...
+    loopCmdTable[f"npu_drops{card}_{npu_inst}"] = npuStats
+    loopCmdTable[f"dvoq_check{card}_{npu_inst}"] = read_dvoq
+    loopCmdTable[f"oq_debug_full{card}_{npu_inst}"] = oq_debug
+    loopCmdTable[f"summ_ctrs{card}_{npu_inst}"] = summ_ctrs
+    loopCmdGroups[f"npu_batch{card}_{npu_inst}"] = [f"npu_drops{card}_{npu_inst}", f"dvoq_check{card}_{npu_inst}",
+                                                    f"oq_debug_full{card}_{npu_inst}", f"summ_ctrs{card}_{npu_inst}"]
 
 
 if __name__ == '__main__':
     os.nice(20)
     args = getParser()
-    commandOutput = runCommands(runOnceCmdTable)   # run once
+    cctx = zstd.ZstdCompressor(level=3) if zstd else None      # reused across snapshots
+    # run-once output goes in a meta file; each delta just names it
+    onceOutput = runCommands(runOnceCmdTable)   # run once
+    hostname = onceOutput["etcHostname"]
+    filename_leader = args.leader + hostname.decode().strip()
+    snapshot_dir = os.path.abspath(args.output_dir)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    log.info("Using output directory %s", snapshot_dir)
+    stampOutput = runCommands(stampCmdTable)
+    meta_fullpath = getOutputfile(snapshot_dir, filename_leader, "meta", stampOutput["timestamp"])
+    with SnapshotWriter(meta_fullpath, cctx) as writer:
+        writer.update(onceOutput)
+        writer.update(stampOutput)
+    meta_fname = os.path.basename(meta_fullpath)
+    del onceOutput
+    dictSamples = [] if zstd else None          # entries collected until the dictionary is trained
+    lastHashes = {}                             # handle -> (content hash, snapshot holding it)
     run_counter = 0
     finished = False
+    next_deadline = time.monotonic()    # schedule against absolute deadlines so the sample cadence doesn't drift
     while not finished:         # run main loop of commands
         run_counter += 1
-        commandOutput.update(runCommands(loopCmdTable))       
-        output_fullpath = getOutputfile(args, commandOutput)
-        saveJsonXz(commandOutput, output_fullpath)
+        next_deadline += args.time_interval
+        if (run_counter - 1) % DEDUP_RESET_RUNS == 0:
+            lastHashes.clear()          # write this one in full so older snapshots can be deleted
+        stampOutput = runCommands(stampCmdTable)
+        output_fullpath = getOutputfile(snapshot_dir, filename_leader, "delta", stampOutput["timestamp"], run_counter)
+        with SnapshotWriter(output_fullpath, cctx, dictSamples, lastHashes) as writer:
+            writer["etcHostname"] = hostname
+            writer.update(stampOutput)
+            writer["metaFile"] = meta_fname
+            runCommands(loopCmdTable, loopCmdGroups, out=writer)
+        if dictSamples is not None and run_counter >= ZDICT_TRAINING_RUNS:
+            zdict = trainSnapshotDict(snapshot_dir, dictSamples)
+            if zdict:
+                cctx = zstd.ZstdCompressor(level=3, dict_data=zdict)
+            dictSamples = None
         if (run_counter >= args.num_runs):    # are we done?
             finished = True
         else:
-            time.sleep(args.time_interval)
-
-exit(0)
-
+            now = time.monotonic()
+            if args.time_interval and now > next_deadline:
+                # overran the interval: skip the missed sample(s) rather than firing back-to-back
+                missed = int((now - next_deadline) // args.time_interval) + 1
+                log.info("run %d overran the %ds interval, skipping %d sample(s)", run_counter, args.time_interval, missed)
+                next_deadline += missed * args.time_interval
+            time.sleep(max(0, next_deadline - now))